@@ -1,41 +1,243 @@
-from playwright.async_api import async_playwright, Page, Browser, TimeoutError as PlaywrightTimeoutError
-from typing import Optional, List, Dict, Any
+from playwright.async_api import Page, Browser, BrowserContext, Request, Route, TimeoutError as PlaywrightTimeoutError
+from typing import Optional, List, Dict, Any, Set
+from urllib.parse import urlparse
 import logging
 import asyncio
+import re
 
 from app.static_scraper import StaticScraper
 
 logger = logging.getLogger(__name__)
 
+# Chromium features that headless text scraping never uses; --lite-mode turns off
+# V8's optimizing JIT tiers, trading peak JS speed for less memory per page
+CHROMIUM_ARGS = [
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+    "--no-sandbox",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-translate",
+    "--mute-audio",
+    "--no-first-run",
+    "--disable-features=TranslateUI",
+    "--js-flags=--lite-mode",
+]
+
+# Pre-warmed browser contexts shared by concurrent renders, and how many renders
+# each serves before it's replaced to shed accumulated cookies/storage
+CONTEXT_POOL_SIZE = 8
+CONTEXT_MAX_USES = 20
+# Seconds a render waits for a free context before giving up with an error
+CONTEXT_ACQUIRE_TIMEOUT = 30.0
+
+# Ad/telemetry hosts whose beacons and long-polls never settle
+TELEMETRY_HOSTS = (
+    'doubleclick.net',
+    'googletagmanager.com',
+    'google-analytics.com',
+    'googlesyndication.com',
+    'segment.io',
+    'segment.com',
+    'hotjar.com',
+    'facebook.net',
+    'mixpanel.com',
+    'newrelic.com',
+    'nr-data.net',
+    'sentry.io',
+)
+
+# Resource types that never affect extracted content (only img src/alt attributes are read)
+BLOCKED_RESOURCE_TYPES = {'image', 'font', 'media', 'stylesheet'}
+
+# Resource types that stay open indefinitely and say nothing about content readiness
+UNTRACKED_RESOURCE_TYPES = {'websocket', 'media'}
+
+
+# Playwright's :has-text() isn't valid CSS, so the in-page probe matches its text separately
+HAS_TEXT_RE = re.compile(r'^(.*):has-text\("(.*)"\)$')
+
+# Single-round-trip probe: takes [css, text] specs in priority order, marks up to `limit`
+# visible matches of the first spec that has any, and returns their marker selectors
+FIND_VISIBLE_JS = """
+([specs, limit]) => {
+    document.querySelectorAll('[data-scraper-hit]').forEach(el => el.removeAttribute('data-scraper-hit'));
+    const isVisible = el => !!(el.offsetWidth || el.offsetHeight || el.getClientRects().length)
+        && getComputedStyle(el).visibility !== 'hidden';
+    for (const [index, [css, text]] of specs.entries()) {
+        let elements;
+        try {
+            elements = document.querySelectorAll(css);
+        } catch (e) {
+            continue;
+        }
+        const hits = [];
+        for (const el of elements) {
+            if (text && !(el.textContent || '').toLowerCase().includes(text)) continue;
+            if (!isVisible(el)) continue;
+            el.setAttribute('data-scraper-hit', String(hits.length));
+            hits.push(`[data-scraper-hit="${hits.length}"]`);
+            if (hits.length >= limit) break;
+        }
+        if (hits.length) return {index, hits};
+    }
+    return null;
+}
+"""
+
+# Removes the probe's markers so they don't leak into the returned HTML
+CLEAR_HITS_JS = """
+() => document.querySelectorAll('[data-scraper-hit]').forEach(el => el.removeAttribute('data-scraper-hit'))
+"""
+
+
+BODY_SIZE_JS = "() => document.body ? document.body.innerHTML.length : 0"
+
+SCROLL_TO_BOTTOM_JS = """
+() => {
+    const height = document.body.scrollHeight;
+    window.scrollTo(0, height);
+    return height;
+}
+"""
+
+
+def _probe_spec(selector: str) -> List[Optional[str]]:
+    """Split a Playwright selector into the [css, lowercase text] pair used by FIND_VISIBLE_JS"""
+    match = HAS_TEXT_RE.match(selector)
+    if match:
+        return [match.group(1), match.group(2).lower()]
+    return [selector, None]
+
+
+def is_telemetry_url(url: str) -> bool:
+    """Check if a URL points at a known ad/telemetry host"""
+    host = urlparse(url).hostname or ''
+    return any(host == blocked or host.endswith('.' + blocked) for blocked in TELEMETRY_HOSTS)
+
+
+class ContextPool:
+    """Bounded pool of pre-warmed browser contexts on a shared browser"""
+    
+    def __init__(self, browser: Browser, size: int = CONTEXT_POOL_SIZE, max_uses: int = CONTEXT_MAX_USES,
+                 acquire_timeout: float = CONTEXT_ACQUIRE_TIMEOUT):
+        self.browser = browser
+        self.size = size
+        self.max_uses = max_uses
+        self.acquire_timeout = acquire_timeout
+        self.contexts: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self.uses: Dict[BrowserContext, int] = {}
+        self.missing = 0  # Contexts that couldn't be replaced yet
+    
+    async def _new_context(self) -> BrowserContext:
+        """Create a context with a fixed viewport for consistent rendering"""
+        context = await self.browser.new_context(
+            viewport={"width": 1920, "height": 1080},
+            java_script_enabled=True
+        )
+        self.uses[context] = 0
+        return context
+    
+    async def start(self):
+        """Fill the pool"""
+        for _ in range(self.size):
+            self.contexts.put_nowait(await self._new_context())
+    
+    async def _refill(self):
+        """Retry creating contexts whose replacement failed earlier"""
+        while self.missing:
+            self.missing -= 1
+            try:
+                context = await self._new_context()
+            except Exception as e:
+                self.missing += 1
+                logger.error(f"Error refilling browser context pool, {self.missing} missing: {e}")
+                return
+            except BaseException:
+                self.missing += 1
+                raise
+            self.contexts.put_nowait(context)
+    
+    async def acquire(self) -> BrowserContext:
+        """Take a context, waiting up to acquire_timeout while all of them are in use"""
+        await self._refill()
+        try:
+            return await asyncio.wait_for(self.contexts.get(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"No browser context free after {self.acquire_timeout}s") from None
+    
+    async def release(self, context: BrowserContext, discard: bool = False):
+        """Return a context, replacing it if it's worn out or possibly broken"""
+        self.uses[context] = self.uses.get(context, 0) + 1
+        if discard or self.uses[context] >= self.max_uses:
+            self.uses.pop(context, None)
+            try:
+                try:
+                    await context.close()
+                except Exception as e:
+                    logger.error(f"Error closing browser context: {e}")
+                context = await self._new_context()
+            except Exception as e:
+                # Retried on the next acquire() so the pool doesn't shrink for good
+                self.missing += 1
+                logger.error(f"Error replacing browser context, {self.missing} missing: {e}")
+                return
+            except BaseException:
+                # Cancelled mid-rotation, e.g. a speculative render's __aexit__; the
+                # slot still has to be refilled later
+                self.missing += 1
+                raise
+        self.contexts.put_nowait(context)
+    
+    async def close(self):
+        """Close every context the pool owns"""
+        for context in list(self.uses):
+            await context.close()
+        self.uses.clear()
+
 
 class JSRenderer:
     """Renderer for JavaScript-heavy pages using Playwright"""
     
-    def __init__(self, url: str):
+    def __init__(self, url: str, pool: ContextPool):
         self.url = url
-        self.browser: Optional[Browser] = None
+        self.pool = pool
+        self.context: Optional[BrowserContext] = None
         self.page: Optional[Page] = None
-        self.visited_urls: List[str] = [url]
+        self.visited_urls: List[str] = [url]  # Ordered, for the response
+        self._visited_set: Set[str] = {url}  # Same URLs, for O(1) membership checks
         self.clicks: List[str] = []
         self.scroll_count: int = 0
+        self.pending_requests: Set[Request] = set()
     
     async def __aenter__(self):
         """Context manager entry"""
-        self.playwright = await async_playwright().start()
-        self.browser = await self.playwright.chromium.launch(headless=True)
-        self.page = await self.browser.new_page()
-        # Set viewport for consistent rendering
-        await self.page.set_viewport_size({"width": 1920, "height": 1080})
+        self.context = await self.pool.acquire()
+        # __aexit__ won't run if this fails, so hand the context back here; BaseException
+        # covers cancellation of speculative renders
+        try:
+            self.page = await self.context.new_page()
+            # Abort non-essential resources and trackers before navigation
+            await self.page.route("**/*", self._route_request)
+            # Track in-flight requests for the network quiet-period wait
+            self.page.on('request', self._on_request)
+            self.page.on('requestfinished', self._on_request_done)
+            self.page.on('requestfailed', self._on_request_done)
+        except BaseException:
+            await self.pool.release(self.context, discard=True)
+            raise
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Context manager exit"""
-        if self.page:
-            await self.page.close()
-        if self.browser:
-            await self.browser.close()
-        if self.playwright:
-            await self.playwright.stop()
+        # The context goes back to the pool; a failed render may have left it broken
+        try:
+            if self.page:
+                await self.page.close()
+        finally:
+            await self.pool.release(self.context, discard=exc_type is not None)
     
     async def render(self) -> tuple[str, List[str], List[str], int]:
         """
@@ -44,10 +246,17 @@ class JSRenderer:
         try:
             # Navigate to the page
             logger.info(f"Navigating to {self.url}")
-            await self.page.goto(self.url, wait_until='networkidle', timeout=30000)
+            await self.page.goto(self.url, wait_until='domcontentloaded', timeout=15000)
+            await self._wait_for_network_quiet()
             
-            # Wait a bit for any delayed JS to execute
-            await asyncio.sleep(2)
+            # Wait for the document to finish loading and have rendered something
+            try:
+                await self.page.wait_for_function(
+                    "() => document.readyState === 'complete' && document.body && document.body.children.length > 0",
+                    timeout=3000
+                )
+            except PlaywrightTimeoutError:
+                logger.info("Page still loading after 3s, continuing")
             
             # Try to close common overlays
             await self._close_overlays()
@@ -55,7 +264,8 @@ class JSRenderer:
             # Try to detect and handle interactions
             await self._handle_interactions()
             
-            # Get the final HTML
+            # Get the final HTML, without the probe's markers
+            await self._clear_hits()
             html = await self.page.content()
             
             return html, self.clicks, self.visited_urls, self.scroll_count
@@ -63,12 +273,97 @@ class JSRenderer:
         except PlaywrightTimeoutError:
             logger.error(f"Timeout loading {self.url}")
             # Return partial content
+            await self._clear_hits()
             html = await self.page.content() if self.page else ""
             return html, self.clicks, self.visited_urls, self.scroll_count
         except Exception as e:
             logger.error(f"Error rendering page: {e}", exc_info=True)
             raise
     
+    async def _route_request(self, route: Route):
+        """Abort images, fonts, media, stylesheets, and ad/telemetry requests"""
+        request = route.request
+        if request.resource_type in BLOCKED_RESOURCE_TYPES or is_telemetry_url(request.url):
+            await route.abort()
+        else:
+            await route.continue_()
+    
+    def _on_request(self, request: Request):
+        """Start tracking a request unless it's a long-lived or telemetry one"""
+        if request.resource_type in UNTRACKED_RESOURCE_TYPES or is_telemetry_url(request.url):
+            return
+        self.pending_requests.add(request)
+    
+    def _on_request_done(self, request: Request):
+        """Stop tracking a finished or failed request"""
+        self.pending_requests.discard(request)
+    
+    async def _wait_for_network_quiet(self, quiet_period: float = 1.5, max_wait: float = 5.0):
+        """Wait until no tracked request has been in flight for quiet_period, up to max_wait seconds"""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        idle_start: Optional[float] = None
+        
+        while True:
+            now = loop.time()
+            if self.pending_requests:
+                idle_start = None
+            elif idle_start is None:
+                idle_start = now
+            elif now - idle_start >= quiet_period:
+                return
+            
+            if now - start >= max_wait:
+                logger.info(f"Network not quiet after {max_wait}s, continuing with {len(self.pending_requests)} pending requests")
+                return
+            
+            await asyncio.sleep(0.1)
+    
+    async def _body_size(self) -> int:
+        """Length of the body's HTML, used to detect that a click changed the page"""
+        return await self.page.evaluate(BODY_SIZE_JS)
+    
+    async def _wait_for_dom_change(self, before: int, timeout: float = 1000):
+        """Wait until the body's HTML length differs from `before`, giving up after timeout ms"""
+        try:
+            await self.page.wait_for_function(
+                f"size => ({BODY_SIZE_JS})() !== size",
+                arg=before,
+                timeout=timeout,
+                polling=100
+            )
+        except PlaywrightTimeoutError:
+            pass
+    
+    async def _click_and_wait(self, selector: str, click_timeout: float = 2000, wait_timeout: float = 1000):
+        """Click an element, then wait for the page to react instead of sleeping"""
+        before = await self._body_size()
+        await self.page.click(selector, timeout=click_timeout)
+        await self._wait_for_dom_change(before, timeout=wait_timeout)
+    
+    async def _find_visible(self, selectors: List[str], limit: int = 1) -> Optional[tuple[str, List[str]]]:
+        """
+        Find visible elements for the first matching selector in one evaluate call.
+        Returns that selector and clickable marker selectors for up to `limit` elements.
+        """
+        specs = [_probe_spec(selector) for selector in selectors]
+        try:
+            found = await self.page.evaluate(FIND_VISIBLE_JS, [specs, limit])
+        except Exception as e:
+            logger.info(f"DOM probe failed: {e}")
+            return None
+        
+        if not found:
+            return None
+        return selectors[found['index']], found['hits']
+    
+    async def _clear_hits(self):
+        """Strip the markers left by _find_visible from the live page"""
+        try:
+            await self.page.evaluate(CLEAR_HITS_JS)
+        except Exception as e:
+            logger.info(f"Failed to clear probe markers: {e}")
+    
     async def _close_overlays(self):
         """Try to close common overlays like cookie banners"""
         overlay_selectors = [
@@ -87,16 +382,16 @@ class JSRenderer:
             '.close-button',
         ]
         
-        for selector in overlay_selectors:
-            try:
-                button = self.page.locator(selector).first
-                if await button.is_visible(timeout=1000):
-                    await button.click(timeout=2000)
-                    logger.info(f"Closed overlay: {selector}")
-                    await asyncio.sleep(0.5)
-                    break
-            except:
-                continue
+        found = await self._find_visible(overlay_selectors)
+        if not found:
+            return
+        
+        selector, hits = found
+        try:
+            await self._click_and_wait(hits[0], click_timeout=1500, wait_timeout=1000)
+            logger.info(f"Closed overlay: {selector}")
+        except Exception as e:
+            logger.info(f"Failed to close overlay {selector}: {e}")
     
     async def _handle_interactions(self):
         """Handle tabs, load more buttons, and scrolling"""
@@ -121,26 +416,19 @@ class JSRenderer:
             '[class*="tab" i]:not([role="tabpanel"])',
         ]
         
-        for selector in tab_selectors:
+        # Click up to the first 3 visible tabs of the first matching selector
+        found = await self._find_visible(tab_selectors, limit=3)
+        if not found:
+            return
+        
+        selector, hits = found
+        logger.info(f"Found {len(hits)} tabs with selector: {selector}")
+        for i, hit in enumerate(hits):
             try:
-                tabs = self.page.locator(selector)
-                count = await tabs.count()
-                
-                if count > 0:
-                    logger.info(f"Found {count} tabs with selector: {selector}")
-                    # Click first 3 tabs
-                    for i in range(min(3, count)):
-                        try:
-                            tab = tabs.nth(i)
-                            if await tab.is_visible(timeout=1000):
-                                await tab.click(timeout=2000)
-                                self.clicks.append(f"{selector}[{i}]")
-                                logger.info(f"Clicked tab {i}: {selector}")
-                                await asyncio.sleep(1)  # Wait for content to load
-                        except:
-                            continue
-                    break  # Found and clicked tabs, don't try other selectors
-            except:
+                await self._click_and_wait(hit, wait_timeout=1000)
+                self.clicks.append(f"{selector}[{i}]")
+                logger.info(f"Clicked tab {i}: {selector}")
+            except Exception:
                 continue
     
     async def _handle_load_more(self):
@@ -157,22 +445,18 @@ class JSRenderer:
         ]
         
         for _ in range(3):  # Try up to 3 times
-            clicked = False
-            for selector in load_more_selectors:
-                try:
-                    button = self.page.locator(selector).first
-                    if await button.is_visible(timeout=2000):
-                        await button.click(timeout=2000)
-                        self.clicks.append(selector)
-                        logger.info(f"Clicked load more: {selector}")
-                        await asyncio.sleep(2)  # Wait for content to load
-                        clicked = True
-                        break
-                except:
-                    continue
-            
-            if not clicked:
+            found = await self._find_visible(load_more_selectors)
+            if not found:
                 break  # No more buttons found
+            
+            selector, hits = found
+            try:
+                # Loaded content usually comes over the network, so allow longer for it
+                await self._click_and_wait(hits[0], wait_timeout=2000)
+                self.clicks.append(selector)
+                logger.info(f"Clicked load more: {selector}")
+            except Exception:
+                break
     
     async def _handle_pagination(self):
         """Try to follow pagination links"""
@@ -194,13 +478,17 @@ class JSRenderer:
                         # Get the href before clicking
                         href = await link.get_attribute('href')
                         if href:
+                            before = await self._body_size()
                             await link.click(timeout=2000)
                             logger.info(f"Clicked pagination: {selector}")
-                            await asyncio.sleep(2)  # Wait for page to load
+                            # Wait for the next page (or in-place update) to show up
+                            await self._wait_for_dom_change(before, timeout=2000)
+                            await self.page.wait_for_load_state('domcontentloaded')
                             
                             # Record new URL
                             current_url = self.page.url
-                            if current_url not in self.visited_urls:
+                            if current_url not in self._visited_set:
+                                self._visited_set.add(current_url)
                                 self.visited_urls.append(current_url)
                             
                             clicked = True
@@ -218,25 +506,24 @@ class JSRenderer:
         
         for i in range(max_scrolls):
             try:
-                # Get current scroll height
-                current_height = await self.page.evaluate('document.body.scrollHeight')
+                # Scroll to bottom and read the height in one round-trip
+                current_height = await self.page.evaluate(SCROLL_TO_BOTTOM_JS)
                 
-                if current_height == previous_height and i > 0:
+                if current_height == previous_height:
                     break  # No new content loaded
                 
-                # Scroll to bottom
-                await self.page.evaluate('window.scrollTo(0, document.body.scrollHeight)')
                 self.scroll_count += 1
                 logger.info(f"Scroll {i + 1}/{max_scrolls}")
                 
-                # Wait for content to load
-                await asyncio.sleep(2)
-                
-                # Try to wait for network idle
+                # Wait for the page to actually grow rather than for network silence
                 try:
-                    await self.page.wait_for_load_state('networkidle', timeout=3000)
-                except:
-                    pass
+                    await self.page.wait_for_function(
+                        'height => document.body.scrollHeight > height',
+                        arg=current_height,
+                        timeout=2000
+                    )
+                except PlaywrightTimeoutError:
+                    break  # No new content loaded
                 
                 previous_height = current_height
                 
@@ -245,10 +532,14 @@ class JSRenderer:
                 break
 
 
-async def render_with_js(url: str) -> tuple[Optional[str], List[str], List[str], int]:
+async def render_with_js(url: str, pool: Optional[ContextPool]) -> tuple[Optional[str], List[str], List[str], int]:
     """Render a page with JavaScript and return HTML, clicks, URLs, and scroll count"""
+    if pool is None:
+        logger.error("JS rendering unavailable: browser not initialized")
+        return None, [], [url], 0
+    
     try:
-        async with JSRenderer(url) as renderer:
+        async with JSRenderer(url, pool) as renderer:
             return await renderer.render()
     except Exception as e:
         logger.error(f"Error in JS rendering: {e}")
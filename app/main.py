@@ -3,16 +3,32 @@ from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, HttpUrl, ValidationError
-from typing import Optional
+from playwright.async_api import async_playwright
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+import asyncio
 import logging
+import orjson
+import os
 
 from app.scraper import scrape_url
+from app.static_scraper import USER_AGENT
+from app.js_renderer import CHROMIUM_ARGS, ContextPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Universal Website Scraper")
+
+class ORJSONResponse(JSONResponse):
+    """JSON response encoded with orjson's C encoder instead of the stdlib json module"""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+app = FastAPI(title="Universal Website Scraper", default_response_class=ORJSONResponse)
 
 # Setup Jinja2 templates
 templates = Jinja2Templates(directory="app/templates")
@@ -22,6 +38,51 @@ class ScrapeRequest(BaseModel):
     url: HttpUrl
 
 
+@app.on_event("startup")
+async def startup():
+    """Set up the parsing thread pool and shared HTTP client, launch a shared Chromium instance and pre-warm its contexts"""
+    # HTML parsing runs via asyncio.to_thread, which uses the loop's default executor
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=os.cpu_count()))
+    
+    # One connection pool for all static fetches, so keep-alive/HTTP/2 connections are reused
+    app.state.http = httpx.AsyncClient(
+        follow_redirects=True,
+        http2=True,
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+        headers={"User-Agent": USER_AGENT}
+    )
+    
+    app.state.pw = None
+    app.state.browser = None
+    app.state.ctx_pool = None
+    try:
+        app.state.pw = await async_playwright().start()
+        app.state.browser = await app.state.pw.chromium.launch(
+            headless=True,
+            args=CHROMIUM_ARGS
+        )
+        pool = ContextPool(app.state.browser)
+        await pool.start()
+        app.state.ctx_pool = pool
+        logger.info(f"Shared Chromium browser launched with {pool.size} contexts")
+    except Exception as e:
+        # Static scraping still works without a browser
+        logger.error(f"Failed to launch browser: {e}", exc_info=True)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close the HTTP client, context pool and shared browser, then stop Playwright"""
+    await app.state.http.aclose()
+    if app.state.ctx_pool:
+        await app.state.ctx_pool.close()
+    if app.state.browser:
+        await app.state.browser.close()
+    if app.state.pw:
+        await app.state.pw.stop()
+
+
 @app.get("/healthz")
 async def health_check():
     """Health check endpoint"""
@@ -35,8 +96,8 @@ async def home(request: Request):
 
 
 @app.post("/scrape")
-async def scrape(request: ScrapeRequest):
-    """Scrape a URL and return structured JSON"""
+async def scrape(request: ScrapeRequest, http_request: Request, include_raw_html: bool = True):
+    """Scrape a URL and return structured JSON; ?include_raw_html=false leaves rawHtml empty"""
     try:
         url_str = str(request.url)
         
@@ -51,9 +112,15 @@ async def scrape(request: ScrapeRequest):
             )
         
         logger.info(f"Scraping URL: {url_str}")
-        result = await scrape_url(url_str)
+        result = await scrape_url(
+            url_str,
+            http_request.app.state.http,
+            http_request.app.state.ctx_pool,
+            include_raw_html
+        )
         
-        return {"result": result}
+        # Returned directly so the (large) result skips FastAPI's jsonable_encoder pass
+        return ORJSONResponse(content={"result": result})
     
     except ValidationError as e:
         logger.error(f"Validation error: {e}")
@@ -1,14 +1,62 @@
 from datetime import datetime, timezone
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+from cachetools import LRUCache, TTLCache
+import httpx
+import asyncio
 import logging
 
 from app.static_scraper import StaticScraper, fetch_static_html
-from app.js_renderer import render_with_js
+from app.js_renderer import ContextPool, render_with_js
 
 logger = logging.getLogger(__name__)
 
+# Final scrape results keyed by (url, ETag or Last-Modified, include_raw_html), so a changed page never matches
+_result_cache: TTLCache = TTLCache(maxsize=1024, ttl=300)
 
-async def scrape_url(url: str) -> Dict[str, Any]:
+# Validators last seen for each URL, sent back as a conditional GET
+_validators: TTLCache = TTLCache(maxsize=1024, ttl=300)
+
+# Hosts whose last scrape needed JS rendering (used as a bounded set); for these the
+# render starts alongside the static fetch instead of after it
+_js_hosts: LRUCache = LRUCache(maxsize=256)
+
+
+def _cache_key(
+    url: str,
+    validators: Optional[Dict[str, str]],
+    include_raw_html: bool
+) -> Optional[Tuple[str, str, bool]]:
+    """Build the result cache key, or None if the response can't be revalidated"""
+    if not validators:
+        return None
+    validator = validators.get('etag') or validators.get('last_modified')
+    return (url, validator, include_raw_html) if validator else None
+
+
+def _parse_all(
+    url: str,
+    html: Union[str, bytes],
+    check_sufficient: bool = False,
+    include_raw_html: bool = True,
+    encoding: Optional[str] = None
+) -> Tuple[Optional[Dict[str, Any]], Optional[List[Dict[str, Any]]]]:
+    """
+    Parse HTML and extract metadata and sections. Runs in a worker thread.
+    Returns (None, None) when check_sufficient is set and the content isn't sufficient.
+    """
+    scraper = StaticScraper(url, html, include_raw_html, encoding)
+    if check_sufficient and not scraper.is_sufficient():
+        return None, None
+    return scraper.extract_meta(), scraper.extract_sections()
+
+
+async def scrape_url(
+    url: str,
+    client: httpx.AsyncClient,
+    pool: Optional[ContextPool] = None,
+    include_raw_html: bool = True
+) -> Dict[str, Any]:
     """
     Main scraping function that coordinates static and JS rendering
     """
@@ -34,19 +82,43 @@ async def scrape_url(url: str) -> Dict[str, Any]:
         "errors": errors
     }
     
+    # Only revalidate when we still hold a result to serve on 304
+    cached_validators = _validators.get(url)
+    cached_result = _result_cache.get(_cache_key(url, cached_validators, include_raw_html))
+    if cached_result is None:
+        cached_validators = None
+    
+    host = urlparse(url).netloc
+    render_task: Optional[asyncio.Task] = None
+    if host in _js_hosts and cached_result is None:
+        logger.info(f"{host} needed JS last time, rendering alongside static fetch...")
+        render_task = asyncio.create_task(render_with_js(url, pool))
+    
     try:
         # Step 1: Try static scraping first
         logger.info("Attempting static scraping...")
-        html = await fetch_static_html(url)
+        html, encoding, validators, not_modified = await fetch_static_html(url, client, cached_validators)
+        
+        if not_modified and cached_result is not None:
+            logger.info(f"Not modified, serving cached result for {url}")
+            return cached_result
+        
+        cache_key = _cache_key(url, validators, include_raw_html)
+        if cache_key in _result_cache:
+            logger.info(f"Validator unchanged, serving cached result for {url}")
+            return _result_cache[cache_key]
         
+        rendered = False
         if not html:
             errors.append({
                 "message": "Failed to fetch HTML content",
                 "phase": "fetch"
             })
+            _js_hosts[host] = True
             # Try JS rendering as fallback
             logger.info("Static fetch failed, trying JS rendering...")
-            html, clicks, pages, scrolls = await render_with_js(url)
+            render_task = render_task or asyncio.create_task(render_with_js(url, pool))
+            html, clicks, pages, scrolls = await render_task
             interactions["clicks"] = clicks
             interactions["pages"] = pages
             interactions["scrolls"] = scrolls
@@ -57,24 +129,32 @@ async def scrape_url(url: str) -> Dict[str, Any]:
                     "phase": "render"
                 })
                 return result
+            rendered = True
         
-        # Parse with static scraper
-        scraper = StaticScraper(url, html)
+        # Obvious SPAs skip building a DOM that would be thrown away
+        static_html = html
+        if not rendered and StaticScraper.quick_needs_js(html):
+            meta, sections = None, None
+        else:
+            # Parse in a worker thread so the event loop keeps serving other requests;
+            # only static HTML needs the sufficiency check
+            meta, sections = await asyncio.to_thread(
+                _parse_all, url, html, not rendered, include_raw_html, None if rendered else encoding
+            )
         
-        # Check if static content is sufficient
-        is_sufficient = scraper.is_sufficient()
-        
-        if not is_sufficient:
+        if sections is None:
             logger.info("Static content insufficient, using JS rendering...")
+            _js_hosts[host] = True
             try:
-                html, clicks, pages, scrolls = await render_with_js(url)
+                render_task = render_task or asyncio.create_task(render_with_js(url, pool))
+                html, clicks, pages, scrolls = await render_task
                 interactions["clicks"] = clicks
                 interactions["pages"] = pages
                 interactions["scrolls"] = scrolls
                 
                 if html:
                     # Re-parse with JS-rendered HTML
-                    scraper = StaticScraper(url, html)
+                    meta, sections = await asyncio.to_thread(_parse_all, url, html, False, include_raw_html)
                 else:
                     errors.append({
                         "message": "JS rendering returned empty HTML",
@@ -86,12 +166,16 @@ async def scrape_url(url: str) -> Dict[str, Any]:
                     "message": f"JS rendering failed: {str(e)}",
                     "phase": "render"
                 })
+            
+            # Fall back to the static content if rendering didn't produce any
+            if sections is None:
+                meta, sections = await asyncio.to_thread(
+                    _parse_all, url, static_html, False, include_raw_html, encoding
+                )
+        elif not rendered:
+            _js_hosts.pop(host, None)
         
-        # Extract metadata
-        result["meta"] = scraper.extract_meta()
-        
-        # Extract sections
-        sections = scraper.extract_sections()
+        result["meta"] = meta
         
         # Update sourceUrl for all sections if we visited multiple pages
         if len(interactions["pages"]) > 1:
@@ -103,11 +187,20 @@ async def scrape_url(url: str) -> Dict[str, Any]:
         
         logger.info(f"Successfully scraped {url}: {len(sections)} sections")
         
+        # Cache clean results only, so a transient render failure isn't replayed
+        if cache_key and not errors:
+            _result_cache[cache_key] = result
+            _validators[url] = validators
+        
     except Exception as e:
         logger.error(f"Error in scrape_url: {e}", exc_info=True)
         errors.append({
             "message": f"Unexpected error: {str(e)}",
             "phase": "parse"
         })
+    finally:
+        # Static content won the race (or came from cache); drop the speculative render
+        if render_task and not render_task.done():
+            render_task.cancel()
     
     return result
@@ -1,20 +1,105 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set, Tuple, Union
 from urllib.parse import urljoin, urlparse
 from selectolax.parser import HTMLParser
 import httpx
+import codecs
 import logging
 import re
 
 logger = logging.getLogger(__name__)
 
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
+# Stop reading static responses past this size; the truncated document still parses
+MAX_HTML_BYTES = 2_000_000
+
+# Minimum body text (in characters) for static content to count as sufficient
+MIN_TEXT_LENGTH = 200
+
+# JS framework markers, matched case-insensitively on raw HTML bytes in one pass;
+# the mount points alone are unambiguous enough to skip building a DOM
+JS_INDICATOR_RE = re.compile(rb'''id=["']?(?:root|app|__next)["'\s>]|data-reactroot|ng-app|v-cloak''', re.I)
+JS_MOUNT_RE = re.compile(rb'''id=["']?(?:root|__next)["'\s>]|data-reactroot''', re.I)
+HEAD_END_RE = re.compile(rb'</head\s*>', re.I)
+BODY_TAG_RE = re.compile(rb'<body', re.I)
+
+# Selectors, kept at module scope so every call reuses the same strings
+TITLE_SELECTOR = 'title'
+OG_TITLE_SELECTOR = 'meta[property="og:title"]'
+DESCRIPTION_SELECTOR = 'meta[name="description"]'
+OG_DESCRIPTION_SELECTOR = 'meta[property="og:description"]'
+CANONICAL_SELECTOR = 'link[rel="canonical"]'
+MAIN_SELECTOR = 'main, [role="main"], #main, .main'
+HEADER_SELECTOR = 'header, [role="banner"]'
+NAV_SELECTOR = 'nav, [role="navigation"]'
+SECTION_SELECTOR = 'section, article, [role="region"]'
+FOOTER_SELECTOR = 'footer, [role="contentinfo"]'
+
+# Tags collected by _extract_content, in the order their selector groups list them
+HEADING_TAGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+TEXT_TAGS = ('p', 'span', 'div', 'li', 'td', 'th')
+LIST_TAGS = ('ul', 'ol')
+
+# Per-section output limits
+RAW_HTML_LIMIT = 5000
+MAX_HEADINGS = 20
+MAX_TEXT_PARTS = 50
+MAX_LINKS = 100
+MAX_IMAGES = 100
+
+# Literal "\n"/"\t" escape sequences and runs of whitespace
+WHITESPACE_RE = re.compile(r'(?:\\[nt]|\s)+')
+
+
+def _clean_text(text: str) -> str:
+    """Clean up escape sequences and collapse whitespace"""
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+
+def _body_offset(html: bytes) -> int:
+    """
+    Find where the body starts in raw HTML, so marker scans skip the head.
+    Searching from the end of </head> keeps a "<body" string in a head script or
+    comment from matching; a "</head>" string in one can still end the head early.
+    """
+    head_end = HEAD_END_RE.search(html)
+    start = head_end.end() if head_end else 0
+    body_tag = BODY_TAG_RE.search(html, start)
+    return body_tag.start() if body_tag else start
+
+
+def _bucket_full(buckets: Dict[str, List[str]], order: Tuple[str, ...], tag: str, limit: int) -> bool:
+    """Check if a new item for tag would land past the first `limit` of the buckets concatenated in order"""
+    total = 0
+    for bucket_tag in order:
+        total += len(buckets[bucket_tag])
+        if bucket_tag == tag:
+            break
+    return total >= limit
+
 
 class StaticScraper:
     """Scraper for static HTML content"""
     
-    def __init__(self, url: str, html: str):
+    def __init__(
+        self,
+        url: str,
+        html: Union[str, bytes],
+        include_raw_html: bool = True,
+        encoding: Optional[str] = None
+    ):
         self.url = url
         self.html = html
+        self.include_raw_html = include_raw_html
+        # selectolax only sniffs bytes for a BOM or <meta charset>, so a charset from
+        # the Content-Type header has to be applied here
+        if encoding and isinstance(html, bytes):
+            html = html.decode(encoding, errors='replace')
         self.tree = HTMLParser(html)
+        # Precomputed pieces of the page URL for resolving links without urljoin
+        parsed = urlparse(url)
+        self._scheme = parsed.scheme
+        self._scheme_host = f"{parsed.scheme}://{parsed.netloc}"
     
     def extract_meta(self) -> Dict[str, Any]:
         """Extract metadata from the page"""
@@ -26,68 +111,70 @@ class StaticScraper:
         }
         
         # Extract title
-        title_tag = self.tree.css_first('title')
+        title_tag = self.tree.css_first(TITLE_SELECTOR)
         if title_tag:
             meta["title"] = title_tag.text(strip=True)
         else:
             # Try og:title
-            og_title = self.tree.css_first('meta[property="og:title"]')
+            og_title = self.tree.css_first(OG_TITLE_SELECTOR)
             if og_title and og_title.attributes.get('content'):
                 meta["title"] = og_title.attributes['content']
         
         # Extract description
-        desc_tag = self.tree.css_first('meta[name="description"]')
+        desc_tag = self.tree.css_first(DESCRIPTION_SELECTOR)
         if desc_tag and desc_tag.attributes.get('content'):
             meta["description"] = desc_tag.attributes['content']
         else:
             # Try og:description
-            og_desc = self.tree.css_first('meta[property="og:description"]')
+            og_desc = self.tree.css_first(OG_DESCRIPTION_SELECTOR)
             if og_desc and og_desc.attributes.get('content'):
                 meta["description"] = og_desc.attributes['content']
         
         # Extract language
-        html_tag = self.tree.css_first('html')
+        html_tag = self.tree.root
         if html_tag and html_tag.attributes.get('lang'):
             meta["language"] = html_tag.attributes['lang']
         
         # Extract canonical URL
-        canonical_tag = self.tree.css_first('link[rel="canonical"]')
+        canonical_tag = self.tree.css_first(CANONICAL_SELECTOR)
         if canonical_tag and canonical_tag.attributes.get('href'):
-            meta["canonical"] = urljoin(self.url, canonical_tag.attributes['href'])
+            meta["canonical"] = self._absolute_url(canonical_tag.attributes['href'])
         
         return meta
     
     def extract_sections(self) -> List[Dict[str, Any]]:
         """Extract sections from the page"""
         sections = []
+        # mem_ids of parsed containers; anything nested inside one is already covered
+        visited: Set[int] = set()
         
         # Try to find main content area
-        main = self.tree.css_first('main, [role="main"], #main, .main')
+        main = self.tree.css_first(MAIN_SELECTOR)
         if main:
-            sections.extend(self._parse_container(main, "main"))
+            self._add_container(sections, visited, main, "main")
         
         # Extract header if exists
-        header = self.tree.css_first('header, [role="banner"]')
+        header = self.tree.css_first(HEADER_SELECTOR)
         if header:
-            sections.extend(self._parse_container(header, "nav"))
+            self._add_container(sections, visited, header, "nav")
         
         # Extract navigation
-        nav = self.tree.css_first('nav, [role="navigation"]')
-        if nav and nav != header:
-            sections.extend(self._parse_container(nav, "nav"))
+        nav = self.tree.css_first(NAV_SELECTOR)
+        if nav:
+            self._add_container(sections, visited, nav, "nav")
         
         # Extract sections
-        for section in self.tree.css('section, article, [role="region"]'):
-            sections.extend(self._parse_container(section, "section"))
+        for section in self.tree.css(SECTION_SELECTOR):
+            self._add_container(sections, visited, section, "section")
         
         # Extract footer
-        footer = self.tree.css_first('footer, [role="contentinfo"]')
+        footer = self.tree.css_first(FOOTER_SELECTOR)
         if footer:
-            sections.extend(self._parse_container(footer, "footer"))
+            self._add_container(sections, visited, footer, "footer")
         
         # If no sections found, parse the body
         if not sections:
-            body = self.tree.css_first('body')
+            body = self.tree.body
             if body:
                 sections.extend(self._parse_container(body, "unknown"))
         
@@ -105,7 +192,18 @@ class StaticScraper:
         
         return sections
     
-    def _parse_container(self, container, default_type: str = "section") -> List[Dict[str, Any]]:
+    def _add_container(self, sections: List[Dict[str, Any]], visited: Set[int], container, default_type: str):
+        """Parse a container into sections unless it or one of its ancestors was already parsed"""
+        node = container
+        while node is not None:
+            if node.mem_id in visited:
+                return
+            node = node.parent
+        
+        visited.add(container.mem_id)
+        sections.extend(self._parse_container(container, default_type, len(sections)))
+    
+    def _parse_container(self, container, default_type: str = "section", index: int = 0) -> List[Dict[str, Any]]:
         """Parse a container element into sections"""
         sections = []
         
@@ -118,15 +216,17 @@ class StaticScraper:
         # Generate label
         label = self._generate_label(container, content)
         
-        # Get raw HTML (truncated)
-        raw_html = container.html
+        # Get raw HTML (truncated); serializing the subtree is skipped entirely when not wanted
+        raw_html = ""
         truncated = False
-        if len(raw_html) > 5000:
-            raw_html = raw_html[:5000] + "..."
-            truncated = True
+        if self.include_raw_html:
+            raw_html = container.html
+            if len(raw_html) > RAW_HTML_LIMIT:
+                raw_html = raw_html[:RAW_HTML_LIMIT] + "..."
+                truncated = True
         
-        # Generate unique ID
-        section_id = f"{section_type}-{len(sections)}"
+        # Generate unique ID from the section's position on the page
+        section_id = f"{section_type}-{index}"
         
         sections.append({
             "id": section_id,
@@ -170,86 +270,120 @@ class StaticScraper:
         return default
     
     def _extract_content(self, element) -> Dict[str, Any]:
-        """Extract content from an element"""
-        content = {
-            "headings": [],
-            "text": "",
-            "links": [],
-            "images": [],
-            "lists": [],
-            "tables": []
-        }
-        
-        # Extract headings
-        for heading in element.css('h1, h2, h3, h4, h5, h6'):
-            text = heading.text(strip=True)
-            if text:
-                # Clean up escape sequences and normalize whitespace
-                text = text.replace('\\n', ' ').replace('\\t', ' ').replace('\n', ' ').replace('\t', ' ')
-                text = ' '.join(text.split())  # Collapse multiple spaces
-                content["headings"].append(text)
-        
-        # Extract text (excluding script and style)
-        text_parts = []
-        for node in element.css('p, span, div, li, td, th'):
-            text = node.text(strip=True)
-            if text and len(text) > 10:  # Filter out very short text
-                # Clean up escape sequences and normalize whitespace
-                text = text.replace('\\n', ' ').replace('\\t', ' ').replace('\n', ' ').replace('\t', ' ')
-                text = ' '.join(text.split())  # Collapse multiple spaces
-                text_parts.append(text)
-        content["text"] = " ".join(text_parts[:50])  # Limit to first 50 text elements
-        
-        # Extract links
-        for link in element.css('a[href]'):
-            href = link.attributes.get('href', '')
-            text = link.text(strip=True)
-            if href and not href.startswith(('#', 'javascript:')):
-                absolute_url = urljoin(self.url, href)
-                # Clean up link text
-                if text:
-                    text = text.replace('\\n', ' ').replace('\\t', ' ').replace('\n', ' ').replace('\t', ' ')
-                    text = ' '.join(text.split())
-                content["links"].append({
-                    "text": text or href,
-                    "href": absolute_url
-                })
-        
-        # Extract images
-        for img in element.css('img[src]'):
-            src = img.attributes.get('src', '')
-            alt = img.attributes.get('alt', '')
-            if src:
-                absolute_src = urljoin(self.url, src)
-                content["images"].append({
-                    "src": absolute_src,
-                    "alt": alt
-                })
-        
-        # Extract lists
-        for ul in element.css('ul, ol'):
-            list_items = []
-            for li in ul.css('li'):
-                text = li.text(strip=True)
+        """Extract content from an element in a single depth-first walk"""
+        content = self._extract_empty_content()
+        
+        # css() with a selector group returns matches grouped by selector, so
+        # buckets keyed by tag keep that order (all h1s before h2s, p before span, ...)
+        headings: Dict[str, List[str]] = {tag: [] for tag in HEADING_TAGS}
+        text_parts: Dict[str, List[str]] = {tag: [] for tag in TEXT_TAGS}
+        lists: Dict[str, List[List[str]]] = {tag: [] for tag in LIST_TAGS}
+        tables: List[List[Dict[str, List[str]]]] = []
+        
+        # Containers whose subtree is still being walked, as (depth, items)
+        open_lists: List[Tuple[int, List[str]]] = []
+        open_tables: List[Tuple[int, List[Dict[str, List[str]]]]] = []
+        open_rows: List[Tuple[int, Dict[str, List[str]]]] = []
+        
+        # Stack of child iterators; the element itself is visited first, as css() also matches it
+        stack = [iter((element,))]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                depth = len(stack)
+                while open_rows and open_rows[-1][0] >= depth:
+                    open_rows.pop()
+                while open_tables and open_tables[-1][0] >= depth:
+                    open_tables.pop()
+                while open_lists and open_lists[-1][0] >= depth:
+                    open_lists.pop()
+                continue
+            
+            depth = len(stack)
+            tag = node.tag
+            text = None
+            
+            # Skip text serialization for anything past the output limits
+            if tag in headings and not _bucket_full(headings, HEADING_TAGS, tag, MAX_HEADINGS):
+                text = node.text(strip=True)
                 if text:
+                    headings[tag].append(_clean_text(text))
+            
+            if tag in text_parts:
+                wants_part = not _bucket_full(text_parts, TEXT_TAGS, tag, MAX_TEXT_PARTS)
+                # List items and cells still need their text once the text budget is spent
+                if wants_part or (tag == 'li' and open_lists) or (tag in ('td', 'th') and open_rows):
+                    text = node.text(strip=True)
+                    if wants_part and len(text) > 10:  # Filter out very short text
+                        text_parts[tag].append(text)
+            
+            if tag == 'a':
+                href = node.attributes.get('href')
+                if len(content["links"]) < MAX_LINKS and href and not href.startswith(('#', 'javascript:')):
+                    link_text = node.text(strip=True)
+                    content["links"].append({
+                        "text": (_clean_text(link_text) if link_text else '') or href,
+                        "href": self._absolute_url(href)
+                    })
+            elif tag == 'img':
+                src = node.attributes.get('src')
+                if len(content["images"]) < MAX_IMAGES and src:
+                    content["images"].append({
+                        "src": self._absolute_url(src),
+                        "alt": node.attributes.get('alt', '')
+                    })
+            elif tag in lists:
+                list_items: List[str] = []
+                lists[tag].append(list_items)
+                open_lists.append((depth, list_items))
+            elif tag == 'table':
+                table_rows: List[Dict[str, List[str]]] = []
+                tables.append(table_rows)
+                open_tables.append((depth, table_rows))
+            elif tag == 'tr':
+                # Rows, items and cells belong to every enclosing table/list/row, as with nested css() lookups
+                row_cells: Dict[str, List[str]] = {'td': [], 'th': []}
+                for _, table_rows in open_tables:
+                    table_rows.append(row_cells)
+                open_rows.append((depth, row_cells))
+            elif tag == 'li' and text:
+                for _, list_items in open_lists:
                     list_items.append(text)
-            if list_items:
-                content["lists"].append(list_items)
-        
-        # Extract tables
-        for table in element.css('table'):
-            table_data = []
-            for row in table.css('tr'):
-                row_data = []
-                for cell in row.css('td, th'):
-                    row_data.append(cell.text(strip=True))
-                if row_data:
-                    table_data.append(row_data)
+            elif tag in ('td', 'th'):
+                for _, row_cells in open_rows:
+                    row_cells[tag].append(text)
+            
+            stack.append(node.iter())
+        
+        content["headings"] = [text for tag in HEADING_TAGS for text in headings[tag]][:MAX_HEADINGS]
+        
+        all_parts = [text for tag in TEXT_TAGS for text in text_parts[tag]]
+        content["text"] = _clean_text(" ".join(all_parts[:MAX_TEXT_PARTS]))
+        
+        content["lists"] = [list_items for tag in LIST_TAGS for list_items in lists[tag] if list_items]
+        
+        for table_rows in tables:
+            table_data = [row_cells['td'] + row_cells['th'] for row_cells in table_rows]
+            table_data = [row_data for row_data in table_data if row_data]
             if table_data:
                 content["tables"].append(table_data)
         
         return content
     
+    def _absolute_url(self, href: str) -> str:
+        """Resolve a link against the page URL, skipping urljoin for the common cases"""
+        if href.startswith(('http://', 'https://')):
+            return href
+        if href.startswith('//'):
+            # Protocol-relative, only when a host follows ('//', '///x' or '//?x' resolve differently)
+            if len(href) > 2 and href[2] not in '/?#':
+                return f"{self._scheme}:{href}"
+        # Root-relative paths, unless they need dot-segment resolution
+        elif href.startswith('/') and '/.' not in href:
+            return self._scheme_host + href
+        return urljoin(self.url, href)
+    
     def _extract_empty_content(self) -> Dict[str, Any]:
         """Return empty content structure"""
         return {
@@ -284,45 +418,97 @@ class StaticScraper:
         tag_name = element.tag if hasattr(element, 'tag') else 'Section'
         return f"{tag_name.capitalize()} Content"
     
+    @classmethod
+    def quick_needs_js(cls, html: bytes) -> bool:
+        """Check raw HTML for pages that clearly need JS rendering, without building a DOM"""
+        # Too short to hold enough text
+        if len(html) < MIN_TEXT_LENGTH:
+            return True
+        
+        # Mount points only count in the body, matching is_sufficient
+        match = JS_MOUNT_RE.search(html, _body_offset(html))
+        if match:
+            logger.info(f"Found JS indicator: {match.group().decode(errors='replace')}")
+            return True
+        
+        return False
+    
     def is_sufficient(self) -> bool:
         """Check if static content is sufficient"""
         # Check if there's enough text content
-        body = self.tree.css_first('body')
+        body = self.tree.body
         if not body:
             return False
         
-        text = body.text(strip=True)
-        if len(text) < 200:  # Less than 200 characters suggests JS rendering
+        # Count stripped text nodes only until the threshold is reached, rather than
+        # serializing the whole body; less than 200 characters suggests JS rendering
+        text_length = 0
+        for node in body.traverse(include_text=True):
+            if node.tag == '-text':
+                text_length += len(node.text(strip=True))
+                if text_length >= MIN_TEXT_LENGTH:
+                    break
+        else:
             return False
         
-        # Check for common JS framework indicators
-        body_html = body.html.lower()
-        js_indicators = [
-            'id="root"',
-            'id="app"',
-            'id="__next"',
-            'data-reactroot',
-            'ng-app',
-            'v-cloak'
-        ]
-        
-        for indicator in js_indicators:
-            if indicator in body_html:
-                logger.info(f"Found JS indicator: {indicator}")
-                return False
+        # Check for common JS framework indicators in the raw body, without
+        # re-serializing and lowercasing it
+        html = self.html if isinstance(self.html, bytes) else self.html.encode()
+        match = JS_INDICATOR_RE.search(html, _body_offset(html))
+        if match:
+            logger.info(f"Found JS indicator: {match.group().decode(errors='replace')}")
+            return False
         
         return True
 
 
-async def fetch_static_html(url: str) -> Optional[str]:
-    """Fetch HTML content using httpx"""
+async def fetch_static_html(
+    url: str,
+    client: httpx.AsyncClient,
+    validators: Optional[Dict[str, str]] = None
+) -> Tuple[Optional[bytes], Optional[str], Dict[str, str], bool]:
+    """
+    Fetch raw HTML bytes with the shared httpx client, reading at most MAX_HTML_BYTES.
+    
+    Sends If-None-Match / If-Modified-Since when cache validators are given.
+    Returns the HTML, the charset declared in Content-Type (None if absent or
+    unknown), the response's validators, and whether the server answered
+    304 Not Modified.
+    """
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    
     try:
-        async with httpx.AsyncClient(follow_redirects=True, timeout=30.0) as client:
-            response = await client.get(url, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            })
+        async with client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304:
+                return None, None, validators or {}, True
             response.raise_for_status()
-            return response.text
+            response_validators = {
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified')
+            }
+            
+            encoding = response.charset_encoding
+            if encoding:
+                try:
+                    codecs.lookup(encoding)
+                except LookupError:
+                    logger.info(f"Unknown charset {encoding!r}, leaving detection to the parser")
+                    encoding = None
+            
+            html = bytearray()
+            async for chunk in response.aiter_bytes():
+                html.extend(chunk)
+                if len(html) >= MAX_HTML_BYTES:
+                    logger.info(f"Response exceeds {MAX_HTML_BYTES} bytes, truncating")
+                    del html[MAX_HTML_BYTES:]
+                    break
+            
+            return bytes(html), encoding, response_validators, False
     except Exception as e:
         logger.error(f"Error fetching URL: {e}")
-        return None
+        return None, None, {}, False